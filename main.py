@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import argparse
-import io
+import collections
+import fnmatch
+import http.client
 import json
 import os
-import queue
 import shutil
 import signal
 import subprocess
@@ -12,6 +13,7 @@ import sys
 import tempfile
 import threading
 import time
+import urllib.parse
 import urllib.request
 import uuid
 import zipfile
@@ -23,121 +25,279 @@ CACHE = os.path.abspath('cache')
 VENDOR = os.path.abspath('vendor')
 FIRST_COMMIT = 'b1767a6a76ee31f8c63a37ae1dfb9eca82172edf'
 LAST_COMMIT = 'b6083b163df0984becf8596976f60c9a30d41532'
+# files which can affect mypy's output
+PATHSPEC = (
+    '*.py', '*.pyi', 'requirements*.txt', 'pyproject.toml', '.python-version',
+)
 
 
 def _determine_commits() -> list[str]:
-    out = subprocess.check_output((
+    log_cmd = (
         'git', '-C', SRC,
         'log', '--format=%H', '--reverse',
-        f'{FIRST_COMMIT}..{LAST_COMMIT}', '--',
-        '*.py', '*.pyi', 'requirements*.txt', 'pyproject.toml',
-        '.python-version',
-    ))
-    commit_ids = [line.decode() for line in out.splitlines()]
-    # ok git :)
-    commit_ids.insert(0, FIRST_COMMIT)
-
-    completed = set()
-    for maybe_done in os.listdir(DATA):
-        if (
-                len(maybe_done) == 40 and
-                all(
-                    os.path.exists(os.path.join(DATA, maybe_done, fn))
-                    for fn in ('info.json', 'mypy-out')
-                )
-        ):
-            completed.add(maybe_done)
-        else:
-            shutil.rmtree(os.path.join(DATA, maybe_done))
+        f'{FIRST_COMMIT}..{LAST_COMMIT}', '--', *PATHSPEC,
+    )
+    # let git walk history while DATA is being scanned
+    with subprocess.Popen(log_cmd, stdout=subprocess.PIPE) as proc:
+        completed = set()
+        with os.scandir(DATA) as it:
+            for maybe_done in it:
+                if (
+                        len(maybe_done.name) == 40 and
+                        maybe_done.is_dir(follow_symlinks=False) and
+                        {'info.json', 'mypy-out'} <= set(
+                            os.listdir(maybe_done.path),
+                        )
+                ):
+                    completed.add(maybe_done.name)
+                else:
+                    shutil.rmtree(maybe_done.path)
+
+        assert proc.stdout is not None
+        # ok git :)
+        commit_ids = [FIRST_COMMIT]
+        commit_ids.extend(line.rstrip().decode() for line in proc.stdout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, log_cmd)
 
     todo = [cid for cid in commit_ids if cid not in completed]
     print(f'skipping {len(commit_ids) - len(todo)} already done!')
     return todo
 
 
-PROG = '''\
-pip install \
+class Meta(NamedTuple):
+    python: str
+    author: str
+    commit_time: int
+    lines_changed: int
+
+
+def _commit_meta(cids: list[str]) -> dict[str, Meta]:
+    log_out = subprocess.check_output(
+        (
+            'git', '-C', SRC,
+            'log', '--no-walk=unsorted', '--stdin',
+            '--format=commit %H\t%an <%ae>\t%ct', '--numstat', '--no-renames',
+        ),
+        input=''.join(f'{cid}\n' for cid in cids).encode(),
+    )
+    authors = {}
+    lines_changed: collections.Counter[str] = collections.Counter()
+    prev = ''
+    for line in log_out.decode().splitlines():
+        if not line:
+            continue
+        elif line.startswith('commit '):
+            prev, author, ct_s = line.removeprefix('commit ').split('\t')
+            authors[prev] = (author, int(ct_s))
+        else:  # `{added}\t{deleted}\t{path}` (`-` for binary files)
+            added, deleted, path = line.split('\t', 2)
+            if (
+                    added != '-' and
+                    any(fnmatch.fnmatchcase(path, pat) for pat in PATHSPEC)
+            ):
+                lines_changed[prev] += int(added) + int(deleted)
+
+    # one blob per commit: `<oid> blob <size>\n<contents>\n`
+    blobs = subprocess.check_output(
+        ('git', '-C', SRC, 'cat-file', '--batch'),
+        input=''.join(f'{cid}:.python-version\n' for cid in cids).encode(),
+    )
+    ret = {}
+    pos = 0
+    for cid in cids:
+        header_end = blobs.index(b'\n', pos)
+        _, _, size_s = blobs[pos:header_end].split()
+        pos = header_end + 1 + int(size_s) + 1
+        version = blobs[header_end + 1:pos - 1].decode().strip()
+        ver, _ = version.rsplit('.', 1)
+        ret[cid] = Meta(ver, *authors[cid], lines_changed[cid])
+    return ret
+
+
+CONTAINERFILE = '''\
+FROM python:{ver}-slim
+RUN pip install \
     --cache-dir /cache/pip \
     --disable-pip-version-check \
     --quiet \
     --root-user-action=ignore \
     uv==0.8.19
+'''
 
-uv venv /.venv --quiet --no-managed-python -p $(which python)
-export PATH=/.venv/bin:$PATH VIRTUAL_ENV=/.venv
-
-cd /src
-if [ -f requirements-dev-frozen.txt ]; then
-    uv pip install -r requirements-dev-frozen.txt --cache-dir /cache/uv --quiet
-else
-    uv sync --active --frozen --quiet --cache-dir /cache/uv
-fi
-
-python /vendor/fast_editable.py >& /dev/null
 
-sentry init
+def _image(ver: str) -> str:
+    return f'localhost/sentry-mypy-stats:py{ver}'
 
-pip freeze | grep '^mypy==' > /data/mypy-version
 
-! python -m tools.mypy_helpers.mypy_without_ignores > /data/mypy-out
-'''
+def _build_image(ver: str) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, 'Containerfile'), 'w') as f:
+            f.write(CONTAINERFILE.format(ver=ver))
 
+        subprocess.check_call(
+            (
+                'podman', 'build', '--quiet',
+                '--volume', f'{CACHE}:/cache:rw',
+                '--tag', _image(ver),
+                tmpdir,
+            ),
+            stdout=subprocess.DEVNULL,
+        )
 
-def _threaded_worker(q: queue.Queue[str]) -> None:
-    while True:
-        try:
-            cid = q.get(timeout=.5)
-        except queue.Empty:
-            return
 
-        ver_cmd = ('git', '-C', SRC, 'show', f'{cid}:.python-version')
-        version = subprocess.check_output(ver_cmd).decode().strip()
-        ver, _ = version.rsplit('.', 1)
+SETUP = '''\
+uv venv /.venv --quiet --no-managed-python -p $(which python)
+'''
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            src = os.path.join(tmpdir, 'src')
-            data = os.path.join(tmpdir, 'data')
-            os.makedirs(data)
+PROG = '''\
+export PATH=/.venv/bin:$PATH VIRTUAL_ENV=/.venv
 
-            subprocess.check_call((
-                'git', 'clone', '--quiet', '--shared', '--no-checkout',
-                SRC, src,
-            ))
-            subprocess.check_call(('git', '-C', src, 'checkout', '-q', cid))
+cd /work/src
+deps="$(cat requirements*.txt pyproject.toml uv.lock 2> /dev/null | sha256sum)"
+if [ "$deps" != "$(cat /.venv/.deps 2> /dev/null)" ]; then
+    if [ -f requirements-dev-frozen.txt ]; then
+        uv pip sync requirements-dev-frozen.txt --cache-dir /cache/uv --quiet
+    else
+        uv sync --active --frozen --quiet --cache-dir /cache/uv
+    fi
+    echo "$deps" > /.venv/.deps
+fi
 
-            info_out = subprocess.check_output((
-                'git', '-C', src,
-                'show', '--no-patch', '--format=%an <%ae>\t%ct', 'HEAD',
-            )).strip().decode()
-            author, ct_s = info_out.split('\t')
+python /vendor/fast_editable.py >& /dev/null
 
-            subprocess.check_call((
-                'podman', 'run', '--rm',
-                '-v', f'{VENDOR}:/vendor:ro',
-                '-v', f'{CACHE}:/cache:rw',
-                '-v', f'{data}:/data:rw',
-                '-v', f'{src}:/src:rw',
-                f'python:{ver}-slim',
-                'bash', '-euc', PROG,
-            ))
+rm -rf ~/.sentry
+sentry init
 
-            with open(os.path.join(data, 'mypy-version')) as f:
-                mypy_version = f.read().strip()
+MYPY="$(pip freeze | grep '^mypy==')"
+export MYPY
+python -c '
+import json, os
+info = {
+    "python": os.environ["PYVER"],
+    "mypy": os.environ["MYPY"],
+    "author": os.environ["AUTHOR"],
+    "commit_time": int(os.environ["COMMIT_TIME"]),
+}
+with open(os.path.join(os.environ["OUT"], "info.json"), "w") as f:
+    json.dump(info, f)
+'
+
+# unchanged modules are not re-checked between commits.  the cache is per
+# worker: mypy's cache is not safe to share between concurrent runs
+export MYPY_CACHE_DIR="/work/mypy-cache/py$PYVER-${MYPY#mypy==}"
+mkdir -p "$MYPY_CACHE_DIR"
+
+! python -m tools.mypy_helpers.mypy_without_ignores > "$OUT/mypy-out"
+'''
 
-            with tempfile.TemporaryDirectory(dir=DATA, delete=False) as tdir:
-                info = {
-                    'python': ver,
-                    'mypy': mypy_version,
-                    'author': author,
-                    'commit_time': int(ct_s),
-                }
-                info_json = os.path.join(tdir, 'info.json')
-                with open(info_json, 'w') as f:
-                    json.dump(info, f)
 
-                shutil.copy(os.path.join(data, 'mypy-out'), tdir)
+def _extract(cid: str, dest: str) -> None:
+    archive_cmd = (
+        'git', '-C', SRC, 'archive', '--format=tar', cid, '--',
+        # the frontend is a large part of the tree and mypy never reads it
+        ':(exclude)static',
+    )
+    with subprocess.Popen(archive_cmd, stdout=subprocess.PIPE) as archive:
+        assert archive.stdout is not None
+        # -m: archive mtimes are the commit time which can repeat between
+        # commits -- mypy's cache would then trust stale (size, mtime) pairs
+        tar_cmd = ('tar', '-x', '-m', '-C', dest)
+        subprocess.check_call(tar_cmd, stdin=archive.stdout)
+    if archive.returncode:
+        raise subprocess.CalledProcessError(archive.returncode, archive_cmd)
+
+
+def _start_container(ver: str, workdir: str) -> str:
+    container = subprocess.check_output((
+        'podman', 'run', '--rm', '--detach', '--init',
+        '-v', f'{VENDOR}:/vendor:ro',
+        '-v', f'{CACHE}:/cache:rw',
+        '-v', f'{DATA}:/data:rw',
+        '-v', f'{workdir}:/work:rw',
+        _image(ver),
+        'sleep', 'infinity',
+    )).decode().strip()
+    try:
+        setup_cmd = ('podman', 'exec', container, 'bash', '-euc', SETUP)
+        subprocess.check_call(setup_cmd)
+    except BaseException:
+        _stop_container(container)
+        raise
+    return container
+
+
+def _stop_container(container: str) -> None:
+    subprocess.check_call(
+        ('podman', 'rm', '--force', '--time=0', container),
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def _take(
+        q: dict[str, collections.deque[str]],
+        ver: str | None = None,
+) -> str | None:
+    if ver is not None:
+        try:
+            return q[ver].popleft()
+        except IndexError:
+            pass
 
-                os.rename(tdir, os.path.join(DATA, cid))
+    # otherwise steal from whichever python version has the most left
+    for other in sorted(q, key=lambda k: len(q[k]), reverse=True):
+        try:
+            return q[other].popleft()
+        except IndexError:
+            continue
+    return None
+
+
+def _threaded_worker(
+        q: dict[str, collections.deque[str]],
+        meta: dict[str, Meta],
+) -> None:
+    # each worker sticks to one python version for as long as there is work
+    # for it: the container (and its venv) is reused between commits and the
+    # dependencies are only re-synced when they change
+    ver = None
+    container = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src')
+        try:
+            while (cid := _take(q, ver)) is not None:
+                commit = meta[cid]
+                if container is None or commit.python != ver:
+                    if container is not None:
+                        _stop_container(container)
+                        container = None
+                    container = _start_container(commit.python, tmpdir)
+                    ver = commit.python
+
+                shutil.rmtree(src, ignore_errors=True)
+                os.makedirs(src)
+                _extract(cid, src)
+
+                # the container writes `info.json` + `mypy-out` directly
+                # into a scratch dir in DATA which is then renamed in place
+                data = tempfile.mkdtemp(dir=DATA)
+                try:
+                    subprocess.check_call((
+                        'podman', 'exec',
+                        '--env', f'OUT=/data/{os.path.basename(data)}',
+                        '--env', f'PYVER={commit.python}',
+                        '--env', f'AUTHOR={commit.author}',
+                        '--env', f'COMMIT_TIME={commit.commit_time}',
+                        container,
+                        'bash', '-euc', PROG,
+                    ))
+                except BaseException:
+                    shutil.rmtree(data, ignore_errors=True)
+                    raise
+                os.rename(data, os.path.join(DATA, cid))
+        finally:
+            if container is not None:
+                _stop_container(container)
 
 
 class SSH(NamedTuple):
@@ -150,30 +310,40 @@ class SSH(NamedTuple):
         return cls(host, int(jobs_s))
 
 
-def _ssh_worker(q: queue.Queue[str], ssh: SSH) -> None:
+# share one authenticated connection per host between ssh / scp calls
+SSH_OPTS = (
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath=/tmp/ssh-mux-%r@%h:%p',
+    '-o', 'ControlPersist=60s',
+)
+
+
+def _ssh_worker(q: dict[str, collections.deque[str]], ssh: SSH) -> None:
     while True:
         items = []
         for _ in range(ssh.jobs):
-            try:
-                items.append(q.get(block=False))
-            except queue.Empty:
+            cid = _take(q)
+            if cid is None:
                 break
+            items.append(cid)
         if not items:
             return
 
-        rm_cmd = ('ssh', ssh.host, 'rm -rf ~/workspace/sentry-mypy-stats/data')
-        subprocess.check_call(rm_cmd)
+        subprocess.check_call((
+            'ssh', *SSH_OPTS, ssh.host,
+            'rm -rf ~/workspace/sentry-mypy-stats/data',
+        ))
 
         pyver = f'python{sys.version_info.major}.{sys.version_info.minor}'
         subprocess.check_call((
-            'ssh', ssh.host,
+            'ssh', *SSH_OPTS, ssh.host,
             f'cd ~/workspace/sentry-mypy-stats && '
             f'{pyver} -m main --jobs {ssh.jobs} {" ".join(items)}',
         ))
 
         with tempfile.TemporaryDirectory(dir=DATA) as tmpdir:
             subprocess.check_call((
-                'scp', '-r', '-q',
+                'scp', *SSH_OPTS, '-r', '-q',
                 f'{ssh.host}:workspace/sentry-mypy-stats/data', tmpdir,
             ))
             data = os.path.join(tmpdir, 'data')
@@ -184,17 +354,55 @@ def _ssh_worker(q: queue.Queue[str], ssh: SSH) -> None:
                 )
 
 
-def _gha_worker(q: queue.Queue[str]) -> None:
+def _gh_api(
+        conn: http.client.HTTPSConnection,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        body: bytes | None = None,
+) -> tuple[http.client.HTTPResponse, bytes]:
+    try:
+        conn.request(method, url, body=body, headers=headers)
+        resp = conn.getresponse()
+        with resp:
+            contents = resp.read()
+    except BaseException:
+        # reset the connection so the next request opens a new one
+        conn.close()
+        raise
+
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(
+            url, resp.status, resp.reason, resp.headers, None,
+        )
+    return resp, contents
+
+
+def _gha_worker(q: dict[str, collections.deque[str]]) -> None:
     with open(os.path.expanduser('~/.github-auth.json')) as f:
         token = json.load(f)['token']
 
+    # reused across the artifact polls (the slow part) of each batch
+    conn = http.client.HTTPSConnection('api.github.com')
+    try:
+        _gha_batches(q, conn, token)
+    finally:
+        conn.close()
+
+
+def _gha_batches(
+        q: dict[str, collections.deque[str]],
+        conn: http.client.HTTPSConnection,
+        token: str,
+) -> None:
+    actions = '/repos/asottile/sentry-mypy-stats/actions'
     while True:
         items = []
         for _ in range(16):
-            try:
-                items.append(q.get(block=False))
-            except queue.Empty:
+            cid = _take(q)
+            if cid is None:
                 break
+            items.append(cid)
         if not items:
             return
 
@@ -203,43 +411,59 @@ def _gha_worker(q: queue.Queue[str]) -> None:
             'ref': 'main',
             'inputs': {'artifact': aid, 'shas': ' '.join(items)},
         }
-        headers = {'Authorization': f'Bearer {token}'}
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'User-Agent': 'sentry-mypy-stats',
+        }
 
-        req = urllib.request.Request(
-            'https://api.github.com/repos/asottile/sentry-mypy-stats/actions/workflows/run.yml/dispatches',  # noqa: E501
-            method='POST',
-            data=json.dumps(data).encode(),
-            headers=headers,
+        # the connection may have been dropped while idle and the dispatch
+        # must not be retried (a duplicate run uploads a second artifact)
+        conn.close()
+        _gh_api(
+            conn, 'POST', f'{actions}/workflows/run.yml/dispatches',
+            headers={**headers, 'Content-Type': 'application/json'},
+            body=json.dumps(data).encode(),
         )
-        urllib.request.urlopen(req).close()
-
-        time.sleep(1200)
 
+        # unchanged listings come back as a 304 which does not count
+        # against the rate limit
+        etag = None
+        delay = 10.
         while True:
+            delay = min(delay * 1.5, 30)
+            time.sleep(delay)
+
+            poll_headers = dict(headers)
+            if etag is not None:
+                poll_headers['If-None-Match'] = etag
             try:
-                req = urllib.request.Request(
-                    f'https://api.github.com/repos/asottile/sentry-mypy-stats/actions/artifacts?name={aid}',  # noqa: E501
-                    headers=headers,
+                resp, contents = _gh_api(
+                    conn, 'GET', f'{actions}/artifacts?name={aid}',
+                    headers=poll_headers,
                 )
-                artifacts_resp = json.load(urllib.request.urlopen(req))
-            except urllib.error.URLError:
-                time.sleep(5)
+            except (OSError, http.client.HTTPException):
+                continue
+            if resp.status == 304:
                 continue
-            else:
-                if artifacts_resp['artifacts']:
-                    break
-                else:
-                    time.sleep(2)
+
+            etag = resp.headers['ETag']
+            artifacts_resp = json.loads(contents)
+            if artifacts_resp['artifacts']:
+                break
 
         artifact, = artifacts_resp['artifacts']
         req = urllib.request.Request(artifact['archive_download_url'])
         for k, v in headers.items():
             req.add_unredirected_header(k, v)
-        contents = urllib.request.urlopen(req).read()
-
-        with tempfile.TemporaryDirectory(dir=DATA) as tmpdir:
-            zipf = zipfile.ZipFile(io.BytesIO(contents))
-            zipf.extractall(tmpdir)
+        with (
+                tempfile.TemporaryFile() as tf,
+                tempfile.TemporaryDirectory(dir=DATA) as tmpdir,
+        ):
+            with urllib.request.urlopen(req) as resp:
+                shutil.copyfileobj(resp, tf, length=1 << 20)
+            tf.seek(0)
+            with zipfile.ZipFile(tf) as zipf:
+                zipf.extractall(tmpdir)
 
             for name in os.listdir(tmpdir):
                 os.rename(
@@ -247,12 +471,9 @@ def _gha_worker(q: queue.Queue[str]) -> None:
                     os.path.join(DATA, name),
                 )
 
-        req = urllib.request.Request(
-            artifact['url'],
-            method='DELETE',
-            headers=headers,
-        )
-        urllib.request.urlopen(req).close()
+        artifact_path = urllib.parse.urlsplit(artifact['url']).path
+        conn.close()  # idle during the download
+        _gh_api(conn, 'DELETE', artifact_path, headers=headers)
 
 
 def main() -> int:
@@ -272,21 +493,34 @@ def main() -> int:
         subprocess.check_call(cmd, stdout=f)
 
     if args.cid:
-        todo = args.cid
+        # full shas: they key the metadata and name the output directories
+        out = subprocess.check_output((
+            'git', '-C', SRC, 'rev-parse',
+            *(f'{cid}^{{commit}}' for cid in args.cid),
+        ))
+        todo = out.decode().split()
     else:
         todo = _determine_commits()
 
-    q: queue.Queue[str] = queue.Queue()
+    meta = _commit_meta(todo)
+    # largest changes first: they are the most likely to be slow (new
+    # dependencies, lots of changed files) so start them before the tail
+    todo.sort(key=lambda cid: meta[cid].lines_changed, reverse=True)
+
+    if args.jobs:
+        for ver in sorted({commit.python for commit in meta.values()}):
+            _build_image(ver)
+
+    # filled before any worker starts so no locking queue is needed: the
+    # deque's append / popleft are atomic
+    q: dict[str, collections.deque[str]] = {}
     for cid in todo:
-        q.put(cid)
+        q.setdefault(meta[cid].python, collections.deque()).append(cid)
 
     def _clear_queue(*a: object) -> None:
         print('USR1: clearing queue and exiting...')
-        while True:
-            try:
-                q.get(timeout=.1)
-            except queue.Empty:
-                break
+        for d in q.values():
+            d.clear()
         raise SystemExit(1)
 
     signal.signal(signal.SIGUSR1, _clear_queue)
@@ -294,7 +528,7 @@ def main() -> int:
     threads = []
 
     for _ in range(args.jobs):
-        t = threading.Thread(target=_threaded_worker, args=(q,))
+        t = threading.Thread(target=_threaded_worker, args=(q, meta))
         threads.append(t)
         t.start()
 